@@ -1,10 +1,23 @@
 import argparse
+import codecs
 from cmd import Cmd
-import copy
 import json
 import os
+import re
 import requests
-from typing import Callable
+import shlex
+import time
+from typing import Callable, Iterator
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 
 class ArgParser:
@@ -28,81 +41,94 @@ class ArgParser:
             exit(2)
 
 
-class ReportParser:
-    def __init__(self):
-        self.PERSISTENT_FILTERS = {'Connection', 'Platform'}
-        self.filter_code_to_name_map = {
-            'ea': 'Endpoint Agents',
-            'eal': 'Endpoint Agent Labels',
-            'loc': 'Location',
-            'pn': 'Private Network',
-            'net': 'Network',
-            'mn': 'Monitored Network'
-        }
+def clone_json(obj):
+    if orjson is not None:
+        return orjson.loads(orjson.dumps(obj))
+    return json.loads(json.dumps(obj))
 
-    def get_template_report(self, raw_report: dict) -> dict:
-        report = copy.deepcopy(raw_report)
+
+def load_json(content: bytes):
+    if orjson is not None:
+        return orjson.loads(content)
+    return json.loads(content)
+
+
+def write_json(f, obj):
+    if orjson is not None:
+        f.write(orjson.dumps(obj, option=orjson.OPT_INDENT_2))
+    else:
+        json.dump(obj, codecs.getwriter('utf-8')(f), indent=2, ensure_ascii=False)
+
+
+class ReportParser:
+    PERSISTENT_FILTERS = frozenset({'Connection', 'Platform'})
+    filter_code_to_name_map = {
+        'ea': 'Endpoint Agents',
+        'eal': 'Endpoint Agent Labels',
+        'loc': 'Location',
+        'pn': 'Private Network',
+        'net': 'Network',
+        'mn': 'Monitored Network'
+    }
+
+    @staticmethod
+    def _iter_filter_dicts(report: dict) -> Iterator[dict]:
         for w in report['widgets']:
             if 'numberCards' in w:
-                for c in w['numberCards']:
-                    c['filters'] = {k: v if k in self.PERSISTENT_FILTERS else [] for k, v in
-                                    c['filters'].items()}
+                yield from (c['filters'] for c in w['numberCards'])
             elif 'filters' in w:
-                w['filters'] = {k: v if k in self.PERSISTENT_FILTERS else [] for k, v in
-                                w['filters'].items()}
+                yield w['filters']
+
+    def _resolve_filter(self, filter_code: str):
+        filter_name = self.filter_code_to_name_map.get(filter_code.lower())
+        if filter_name is None:
+            print(F'The filter code {filter_code} is not supported\n')
+        return filter_name
+
+    def get_template_report(self, raw_report: dict) -> dict:
+        report = clone_json(raw_report)
+        for f in self._iter_filter_dicts(report):
+            for k in f:
+                if k not in self.PERSISTENT_FILTERS:
+                    f[k] = []
         return report
 
     def change_filter_value(self, raw_report: dict, filter_code: str, new_filter_values: list) -> dict:
-        if filter_code not in self.filter_code_to_name_map:
-            print(F'The filter code {filter_code} is not supported\n')
+        filter_name = self._resolve_filter(filter_code)
+        if filter_name is None:
+            return raw_report
+        if not any(filter_name in f and f[filter_name] != new_filter_values
+                   for f in self._iter_filter_dicts(raw_report)):
             return raw_report
 
-        filter_name = self.filter_code_to_name_map[filter_code]
-
-        report = copy.deepcopy(raw_report)
-        for w in report['widgets']:
-            if 'numberCards' in w:
-                for c in w['numberCards']:
-                    c['filters'] = {k: new_filter_values if k == filter_name else v for k, v in
-                                    c['filters'].items()}
-            elif 'filters' in w:
-                w['filters'] = {k: new_filter_values if k == filter_name else v for k, v in
-                                w['filters'].items()}
+        report = clone_json(raw_report)
+        for f in self._iter_filter_dicts(report):
+            if filter_name in f:
+                f[filter_name] = new_filter_values
         return report
 
     def add_filter_value(self, raw_report: dict, filter_code: str, new_filter_values: list) -> dict:
-        if filter_code not in self.filter_code_to_name_map:
-            print(F'The filter code {filter_code} is not supported\n')
+        filter_name = self._resolve_filter(filter_code)
+        if filter_name is None:
+            return raw_report
+        if all(f.get(filter_name) == new_filter_values for f in self._iter_filter_dicts(raw_report)):
             return raw_report
 
-        filter_name = self.filter_code_to_name_map[filter_code]
-
-        report = copy.deepcopy(raw_report)
-        for w in report['widgets']:
-            if 'numberCards' in w:
-                for c in w['numberCards']:
-                    c['filters'][filter_name] = new_filter_values
-            elif 'filters' in w:
-                w['filters'][filter_name] = new_filter_values
+        report = clone_json(raw_report)
+        for f in self._iter_filter_dicts(report):
+            f[filter_name] = new_filter_values
         return report
 
     def remove_filter(self, raw_report: dict, filter_code: str) -> dict:
-        if filter_code not in self.filter_code_to_name_map:
-            print(F'The filter code {filter_code} is not supported\n')
+        filter_name = self._resolve_filter(filter_code)
+        if filter_name is None:
+            return raw_report
+        if not any(filter_name in f for f in self._iter_filter_dicts(raw_report)):
             return raw_report
 
-        filter_name = self.filter_code_to_name_map[filter_code]
-
-        report = copy.deepcopy(raw_report)
-        for w in report['widgets']:
-            if 'numberCards' in w:
-                for c in w['numberCards']:
-                    if filter_name in c['filters']:
-                        del c['filters'][filter_name]
-            elif 'filters' in w:
-                if filter_name in w['filters']:
-                    del w['filters'][filter_name]
-
+        report = clone_json(raw_report)
+        for f in self._iter_filter_dicts(report):
+            f.pop(filter_name, None)
         return report
 
 
@@ -110,14 +136,19 @@ class ReportCli(Cmd):
     intro = 'You are authorised! Type ? for help :P\nIMPORTANT: Check the documentation of each command before use!!\n'
     prompt = '> '
     INVALID_ARGUMENTS_MSG = 'Very invalid arguments over there\n'
+    POSITIVE_ANSWERS = frozenset({'y', 'ye', 'yes', 'yep', 'yarp'})
 
     API_BASE = 'https://api.thousandeyes.com/v7'
     REPORT_API_BASE = 'https://api.thousandeyes.com/v7/reports'
+    REPORT_CACHE_SIZE = 32
+    REPORT_CACHE_TTL = 60  # seconds
 
     def __init__(self):
         super().__init__()
 
         self.arg_parser = ArgParser()
+        self.report_parser = ReportParser()
+        self.report_cache = {}
 
         self.session = requests.Session()
         self.session.auth = (self.arg_parser.username, self.arg_parser.token)
@@ -132,6 +163,15 @@ class ReportCli(Cmd):
             print('You are not authorised with the credential you gave me >( Identify yourself!')
             exit(2)
 
+    def onecmd(self, line):
+        _, arg, _ = self.parseline(line)
+        try:
+            parse_arg(arg or '')
+        except ValueError:
+            print('Unbalanced double quotes in arguments\n')
+            return False
+        return super().onecmd(line)
+
     def do_exit(self, arg):
         """
         Exit the CLI
@@ -148,24 +188,20 @@ class ReportCli(Cmd):
         ACCOUNT_GROUP_ID is optional. If not specified, try to fetch report from default account group
         """
         args = parse_arg(arg)
-        if len(args) is 2:
-            self.session.params = {}
-        elif len(args) is 3:
-            self.session.params = {'aid': args[2]}
-        else:
+        if len(args) not in (2, 3):
             print(self.INVALID_ARGUMENTS_MSG)
             return False
+        aid = args[2] if len(args) == 3 else None
 
         print('Getting your report')
-        report = self.get_report(args[0])
+        report = self.get_report(args[0], aid, use_cache=False)
         if report is None:
             return False
 
-        with open(args[1], 'w') as f:
-            f.write(json.dumps(report, indent=4))
+        with open(args[1], 'wb') as f:
+            write_json(f, report)
             print('Your report is saved!\n')
 
-        self.session.params = {}
         return False
 
     def do_get_template(self, arg):
@@ -176,24 +212,20 @@ class ReportCli(Cmd):
         ACCOUNT_GROUP_ID is optional. If not specified, try to fetch report from default account group
         """
         args = parse_arg(arg)
-        if len(args) is 2:
-            self.session.params = {}
-        elif len(args) is 3:
-            self.session.params = {'aid': args[2]}
-        else:
+        if len(args) not in (2, 3):
             print(self.INVALID_ARGUMENTS_MSG)
             return False
+        aid = args[2] if len(args) == 3 else None
 
         print('Getting your template report')
-        report = self.get_report(args[0])
+        report = self.get_report(args[0], aid)
         if report is None:
             return False
 
-        with open(args[1], 'w') as f:
-            f.write(json.dumps(ReportParser().get_template_report(report), indent=4))
+        with open(args[1], 'wb') as f:
+            write_json(f, self.report_parser.get_template_report(report))
             print('Your template report is saved!\n')
 
-        self.session.params = {}
         return False
 
     def do_get_endpoint_data(self, arg):
@@ -211,7 +243,7 @@ class ReportCli(Cmd):
         Sadly location is not yet supported :(
         """
         args = parse_arg(arg)
-        if len(args) is not 2:
+        if len(args) != 2:
             print(self.INVALID_ARGUMENTS_MSG)
             return False
 
@@ -224,24 +256,26 @@ class ReportCli(Cmd):
         data_type_code, destination_file_name = args
         data_type_code = data_type_code.lower()
         if data_type_code not in data_type_to_api_url_map:
-            print(F'Unsupported data type code {data_type_code}')
+            print(F'Unsupported data type code {data_type_code}\n')
+            return False
 
         api_url = data_type_to_api_url_map[data_type_code]
         r = self.session.get(api_url)
-        if not r.ok or r is None or r.text is None:
+        if not r.ok:
             print(F'Error :(\n')
             return False
 
-        json.loads(r.txt)
+        data = load_json(r.content)
 
-        with open(destination_file_name, 'w') as f:
-            f.write(json.dumps(json.loads(r.text), indent=4))
+        with open(destination_file_name, 'wb') as f:
+            write_json(f, data)
             print('All saved in the file!\n')
         return False
 
     def do_find_endpoint_agent_by_name(self, arg):
         """
-        Find endpoint agent by keyword and store the result in destination file
+        Find endpoint agent by keyword (case-insensitive) in agent or computer name and store the result in
+        destination file
         Usage: find_endpoint_agent_by_name DESTINATION_FILE SEARCH_KEYWORD [SEARCH_KEYWORD ...]
         """
         args = parse_arg(arg)
@@ -249,25 +283,27 @@ class ReportCli(Cmd):
             print(self.INVALID_ARGUMENTS_MSG)
             return False
 
-        r = self.session.get(F'{self.API_BASE}/endpoint-agents.json')
-        if not r.ok or r is None or r.text is None:
-            print(F'Error :(\n')
-            return False
-
-        agents_list = json.loads(r.text)['endpointAgents']
-        keywords = args[1:]
-        search_field = {'agentName', 'computerName'}
-        result_list = []
-        for agent in agents_list:
-            for field in search_field:
-                if field in agent and any(x in agent[field] for x in keywords):
-                    result_list.append(agent)
-
-        with open(args[0], 'w') as f:
-            for r in result_list:
-                f.write(json.dumps(r, indent=4))
-                f.write('\n')
-            print('All saved in the file!\n')
+        with self.session.get(F'{self.API_BASE}/endpoint-agents.json', stream=True) as r:
+            if not r.ok:
+                print(F'Error :(\n')
+                return False
+
+            if ijson is not None:
+                r.raw.decode_content = True
+                agents = ijson.items(r.raw, 'endpointAgents.item', use_float=True)
+            else:
+                agents = load_json(r.content)['endpointAgents']
+
+            keyword_pattern = re.compile('|'.join(map(re.escape, args[1:])), re.IGNORECASE)
+            search_field = {'agentName', 'computerName'}
+            with open(args[0], 'wb') as f:
+                for agent in agents:
+                    for field in search_field:
+                        if field in agent and keyword_pattern.search(agent[field]):
+                            write_json(f, agent)
+                            f.write(b'\n')
+                            break
+                print('All saved in the file!\n')
         return False
 
     def do_add_filter(self, arg):
@@ -288,15 +324,12 @@ class ReportCli(Cmd):
         Note: when changing filter of Endpoint Agents use agent ID!!
         """
         args = parse_arg(arg)
-        if len(args) is 3:
-            self.session.params = {}
-        elif len(args) is 4:
-            self.session.params = {'aid': args[3]}
-        else:
+        if len(args) not in (3, 4):
             print(self.INVALID_ARGUMENTS_MSG)
             return False
+        aid = args[3] if len(args) == 4 else None
 
-        return self.update_report_filter(args[:3], ReportParser().add_filter_value)
+        return self.update_report_filter(args[:3], self.report_parser.add_filter_value, aid)
 
     def do_remove_filter(self, arg):
         """
@@ -315,26 +348,22 @@ class ReportCli(Cmd):
         MN  -- Monitored Network
         """
         args = parse_arg(arg)
-        if len(args) is 2:
-            self.session.params = {}
-        elif len(args) is 3:
-            self.session.params = {'aid': args[2]}
-        else:
+        if len(args) not in (2, 3):
             print(self.INVALID_ARGUMENTS_MSG)
             return False
+        aid = args[2] if len(args) == 3 else None
 
         report_id, filter_code = args[:2]
 
-        raw_report = self.get_report(report_id)
+        raw_report = self.get_report(report_id, aid)
         if raw_report is None:
             return False
 
-        new_report = ReportParser().remove_filter(raw_report, filter_code.lower())
+        new_report = self.report_parser.remove_filter(raw_report, filter_code)
         if new_report != raw_report:
-            self.session.post(F'{self.REPORT_API_BASE}/{report_id}/update', json=new_report)
-            print('Done!\n')
+            if self.update_report(report_id, new_report, aid):
+                print('Done!\n')
 
-        self.session.params = {}
         return False
 
     def do_change_filter_value(self, arg):
@@ -357,15 +386,12 @@ class ReportCli(Cmd):
         Note: when changing filter of Endpoint Agents use agent ID!!
         """
         args = parse_arg(arg)
-        if len(args) is 3:
-            self.session.params = {}
-        elif len(args) is 4:
-            self.session.params = {'aid': args[3]}
-        else:
+        if len(args) not in (3, 4):
             print(self.INVALID_ARGUMENTS_MSG)
             return False
+        aid = args[3] if len(args) == 4 else None
 
-        return self.update_report_filter(args[:3], ReportParser().change_filter_value)
+        return self.update_report_filter(args[:3], self.report_parser.change_filter_value, aid)
 
     def do_export_to_acc_group(self, arg):
         """
@@ -375,9 +401,9 @@ class ReportCli(Cmd):
         Note: USERNAME and AUTH_TOKEN are optional if your current account is in the destination account group too
         """
         args = parse_arg(arg)
-        if len(args) is 3:
+        if len(args) == 3:
             auth = self.session.auth
-        elif len(args) is 5:
+        elif len(args) == 5:
             auth = (args[3], args[4])
         else:
             print(self.INVALID_ARGUMENTS_MSG)
@@ -385,57 +411,94 @@ class ReportCli(Cmd):
 
         report_id, src_acc_group_id, dest_acc_group_id = args[:3]
 
-        self.session.params = {'aid': src_acc_group_id}
-        report = self.get_report(report_id)
+        report = self.get_report(report_id, src_acc_group_id)
         if report is None:
             return False
 
-        positive_answer = {'yes', 'Yes', 'YES', 'ye', 'Ye', 'Y', 'y', 'yep', 'Yep', 'Yarp', 'yarp'}
-        if input('Would you like to rename your export report? [y/n]\n') in positive_answer:
+        if input('Would you like to rename your export report? [y/n]\n').strip().casefold() in self.POSITIVE_ANSWERS:
             new_name = input('Please give me the new name you want for the report.\n')
-            report['title'] = new_name
+            report = {**report, 'title': new_name}
 
-        r = requests.post(F'{self.REPORT_API_BASE}/create', params={'aid': dest_acc_group_id}, auth=auth, json=report)
+        create_url = F'{self.REPORT_API_BASE}/create'
+        if auth == self.session.auth:
+            r = self.session.post(create_url, params={'aid': dest_acc_group_id}, json=report)
+        else:
+            with requests.Session() as session:
+                session.auth = auth
+                r = session.post(create_url, params={'aid': dest_acc_group_id}, json=report)
 
-        if r.status_code is 401:
+        if r.status_code == 401:
             print('You are not authorised, check your credential for the destination account group.\n')
-        elif r is None or r.text is None:
+        elif not r.ok:
             print('Something went wrong :/\n')
         else:
             print(F'Your report is successfully exported to account group {dest_acc_group_id}!\n')
 
-        self.session.params = {}
         return False
 
-    def get_report(self, report_id: str):
-        r = self.session.get(F'{self.REPORT_API_BASE}/{report_id}')
-        if not r.ok or r is None or r.text is None:
+    def get_report(self, report_id: str, aid: str = None, use_cache: bool = True):
+        cache_key = (report_id, aid)
+        cached = self.report_cache.pop(cache_key, None)
+        if use_cache and cached is not None and time.monotonic() - cached[0] < self.REPORT_CACHE_TTL:
+            self.report_cache[cache_key] = cached
+            return cached[1]
+
+        r = self.session.get(F'{self.REPORT_API_BASE}/{report_id}', params={'aid': aid} if aid else None)
+        if not r.ok:
             print(F'Report with id {report_id} does not exist\n')
             return None
         else:
-            return json.loads(r.text)
+            report = load_json(r.content)
+            self.cache_report(cache_key, report)
+            return report
+
+    def update_report(self, report_id: str, report: dict, aid: str = None) -> bool:
+        r = self.session.post(F'{self.REPORT_API_BASE}/{report_id}/update', params={'aid': aid} if aid else None,
+                              json=report)
+        # The same report may be cached under the default and an explicit account group id
+        for cache_key in [k for k in self.report_cache if k[0] == report_id]:
+            del self.report_cache[cache_key]
+        if not r.ok:
+            print(F'Failed to update report with id {report_id} :/\n')
+            return False
+
+        # What we just posted is the current report, so chained edits can start from it
+        self.cache_report((report_id, aid), report)
+        return True
+
+    def cache_report(self, cache_key: tuple, report: dict):
+        if len(self.report_cache) >= self.REPORT_CACHE_SIZE:
+            del self.report_cache[next(iter(self.report_cache))]
+        self.report_cache[cache_key] = (time.monotonic(), report)
 
-    def update_report_filter(self, args: list, report_parser_func: Callable[[dict, str, list], dict]) -> bool:
+    def update_report_filter(self, args: list, report_parser_func: Callable[[dict, str, list], dict],
+                             aid: str = None) -> bool:
         report_id, filter_code, file_name = args
 
-        raw_report = self.get_report(report_id)
+        raw_report = self.get_report(report_id, aid)
         if raw_report is None:
             return False
 
         with open(file_name, 'r') as f:
-            values = list(map(lambda x: x.strip(), f.read().splitlines()))
+            values = [x for x in map(str.strip, f) if x]
 
-        new_report = report_parser_func(raw_report, filter_code.lower(), values)
+        new_report = report_parser_func(raw_report, filter_code, values)
         if new_report != raw_report:
-            self.session.post(F'{self.REPORT_API_BASE}/{report_id}/update', json=new_report)
-            print('Done!\n')
+            if self.update_report(report_id, new_report, aid):
+                print('Done!\n')
 
-        self.session.params = {}
         return False
 
 
 def parse_arg(arg):
-    return arg.split()
+    # Double quotes group arguments; apostrophes and backslashes are kept as-is so names like
+    # "Bob's MacBook" and Windows paths still work
+    lexer = shlex.shlex(arg, posix=True)
+    lexer.whitespace_split = True
+    lexer.commenters = ''
+    lexer.escape = ''
+    lexer.quotes = '"'
+    return tuple(lexer)
 
 
 if __name__ == '__main__':